@@ -1,13 +1,35 @@
 """HDL simulation utilities.
 All simulator executables must be visible in PATH.
 """
+import os
+import queue
+import re
+import shutil
 import subprocess
+import sys
+import threading
 import argparse
+import concurrent.futures
+import hashlib
 from pathlib import Path
 
+# files (glob patterns) regenerated on every run, cleared in incremental mode instead of the whole working directory
+TRANSIENT_FILES = ['dump.*', '*.vcd', 'compile.tcl', 'files.prj']
+
+# files hashed next to sources, as they may be pulled in with `include relative to the source file
+HEADER_EXTS = ('.vh', '.svh', '.h', '.inc', '.v', '.sv')
+
+# compile.tcl / files.prj line templates by source file extension
+_MODELSIM_TMPL = {'.v':   'vlog -nologo -suppress 2902 {*}$DEFS {*}$INCS -sv -timescale "1 ns / 1 ps" %s',
+                  '.sv':  'vlog -nologo -suppress 2902 {*}$DEFS {*}$INCS -sv -timescale "1 ns / 1 ps" %s',
+                  '.vhd': 'vcom -93 %s'}
+_VIVADO_TMPL = {'.sv':  'sv work %s\n',
+                '.v':   'verilog work %s\n',
+                '.vhd': 'vhdl work %s\n'}
+
 def file_ext(filepath):
     """Get file extension from filepath"""
-    return Path(filepath).suffix
+    return os.path.splitext(filepath)[1]
 
 
 def parent_dir(filepath):
@@ -28,48 +50,85 @@ def path_join(*other):
 def remove_tree(dirpath):
     """Remove an entire directory tree if it exists"""
     p = Path(dirpath)
-    if p.exists() and p.is_dir():
-        for child in p.glob('*'):
-            if child.is_file():
-                child.unlink()
-            else:
-                remove_tree(child)
-        p.rmdir()
-
+    if p.is_dir():
+        shutil.rmtree(p)
+
+
+def index_values(items):
+    """Build {name: value} map from list of 'name=value' strings
+    (value of an item without '=' is its name, first occurrence wins)
+    """
+    index = {}
+    for item in items:
+        name, sep, value = item.partition('=')
+        index.setdefault(name, value if sep else name)
+    return index
+
+def merge_values(items, other):
+    """Merge two lists of 'name=value' strings, entries of other replace
+    entries of items with the same name
+    """
+    names = {item.partition('=')[0] for item in other}
+    return [item for item in items if item.partition('=')[0] not in names] + list(other)
 
 def get_define(name, defines):
-    """Return define value from defines list"""
-    try:
-        return next(d for d in defines if name in d).split('=')[-1]
-    except StopIteration:
-        return None
+    """Return define value from defines list (or map built with index_values)"""
+    if not isinstance(defines, dict):
+        defines = index_values(defines)
+    return defines.get(name)
 
 def get_param(name, params):
-    """Return define value from defines list"""
+    """Return parameter value from params list (or map built with index_values)"""
+    if not isinstance(params, dict):
+        params = index_values(params)
+    return params.get(name)
+
+def _drain_pipe(pipe, chunks):
+    """Read pipe in large chunks until EOF, pushing (pipe, chunk) pairs to queue"""
+    while True:
+        chunk = os.read(pipe.fileno(), 65536)
+        chunks.put((pipe, chunk))
+        if not chunk:
+            break
+
+def _run_variant(sim):
+    """Run simulator instance (in pool worker process) and collect its results"""
+    error = None
     try:
-        return next(d for d in params if name in d).split('=')[-1]
-    except StopIteration:
-        return None
+        sim.run()
+    except Exception as exc:  # e.g. tool missing in PATH, keep results of other variants
+        error = exc
+    return {'retcode': sim.retcode, 'stdout': sim.stdout, 'error': error}
+
+def _output_text(buf):
+    """Decode raw tool output as stripped, non-empty lines (as the streaming reader logs them)"""
+    return b'\n'.join(filter(None, map(bytes.strip, buf.split(b'\n')))).decode('utf-8', errors='replace')
 
 def write_memfile(path, data):
     """Write data to memory file (can be loaded with $readmemh)"""
-    with Path(path).open(mode='w', encoding="utf-8") as memfile:
-        memfile.writelines(['%x\n' % d for d in data])
+    Path(path).write_text(''.join(['%x\n' % d for d in data]), encoding="utf-8")
 
 class Simulator:
     """Simulator wrapper"""
-    def __init__(self, name='icarus', gui=False, cwd='work'):
+    _RUNNERS = {'icarus': '_run_icarus',
+                'modelsim': '_run_modelsim',
+                'vivado': '_run_vivado'}
+
+    def __init__(self, name='icarus', gui=False, cwd='work', incremental=False, stream=True):
         self.gui = gui
+        # keep compiled libraries in cwd and skip elaboration if design inputs are unchanged;
+        # inputs are sources, all files under incdirs and HEADER_EXTS files under source directories
+        # (headers found elsewhere, e.g. via tool-specific search paths, are not tracked)
+        self.incremental = incremental
+        # show tool output live; if disabled (and no GUI), it is captured and scanned once at exit
+        self.stream = stream
 
         self.cwd = Path(cwd).resolve()
         if parent_dir(__file__) == self.cwd:
             raise ValueError("Wrong working directory '%s'" % self.cwd)
 
         self.name = name
-        self._runners = {'icarus': self._run_icarus,
-                         'modelsim': self._run_modelsim,
-                         'vivado': self._run_vivado}
-        if self.name not in self._runners.keys():
+        if self.name not in Simulator._RUNNERS:
             raise ValueError("Unknown simulator tool '%s'" % self.name)
 
         self.worklib = 'worklib'
@@ -78,86 +137,287 @@ class Simulator:
         self.defines = []
         self.params  = []
         self.incdirs = []
+        self._resolved_sources = None
+        self._resolved_incdirs = None
+        self._defines_key = self._params_key = None
+        self._defines_len = self._params_len = 0
+        self._defines_map = self._params_map = None
 
         self.stdout = ''
         self.retcode = 0
+        self._stdout_parts = []
+        self._log_buf = []
+        self._log_size = 0
 
         self.sim_errors = ['$error : ', 'Error: ', 'ERROR: ', 'Assertion error']
 
         """Prepare working directory"""
-        remove_tree(self.cwd)
-        make_dir(self.cwd)
+        self._sig_path = path_join(self.cwd, '.pyhdlsim_sig')
+        self._signature = None
+        if not self.incremental:
+            remove_tree(self.cwd)
+            make_dir(self.cwd)
+        elif self.cwd.is_dir():
+            self._clear_transient()
+        else:
+            make_dir(self.cwd)
 
     #def setup(self):
     #    """Prepare working directory"""
     #    remove_tree(self.cwd)
     #    make_dir(self.cwd)
 
+    @classmethod
+    def run_sweep(cls, base_kwargs, variants, jobs=None):
+        """Run independent simulations in parallel, one per variant.
+        Args:
+            base_kwargs : dict with constructor arguments (name, gui, cwd, incremental, stream) and attributes
+                          (sources, defines, params, incdirs, top, ...) shared by all variants
+            variants    : list of dicts with attributes of each variant; defines and params
+                          are merged by name with the base ones (see merge_values),
+                          other values (lists included) replace them
+            jobs        : number of parallel simulations; default is PYHDLSIM_JOBS
+                          environment variable or CPU count
+        Returns:
+            dict mapping variant index to {'retcode': ..., 'stdout': ..., 'error': ...}
+        """
+        attrs = dict(base_kwargs)
+        init_kwargs = {k: attrs.pop(k) for k in ('name', 'gui', 'cwd', 'incremental', 'stream')
+                       if k in attrs}
+        cwd = Path(init_kwargs.pop('cwd', 'work')).resolve()
+        cwd.mkdir(parents=True, exist_ok=True)
+
+        sims = []
+        for i, variant in enumerate(variants):
+            sim = cls(cwd=path_join(cwd, 'var_%d' % i), **init_kwargs)
+            for attr, value in attrs.items():
+                setattr(sim, attr, list(value) if isinstance(value, list) else value)
+            for attr, value in variant.items():
+                if attr in ('defines', 'params'):
+                    value = merge_values(getattr(sim, attr), value)
+                setattr(sim, attr, list(value) if isinstance(value, list) else value)
+            sims.append(sim)
+
+        cpus = os.cpu_count() or 1
+        if not jobs:
+            try:
+                jobs = int(os.environ.get('PYHDLSIM_JOBS') or 0)
+            except ValueError:
+                raise ValueError("PYHDLSIM_JOBS must be an integer, got '%s'" % os.environ['PYHDLSIM_JOBS']) from None
+        jobs = jobs or cpus
+        jobs = max(1, min(jobs, cpus, len(sims)))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            return dict(enumerate(pool.map(_run_variant, sims)))
+
     def run(self):
         """Run selected simulator"""
-        # some preprocessing
-        self.sources = [str(Path(filepath).resolve()).replace('\\','/') for filepath in self.sources]
-        self.incdirs = [str(Path(dirpath).resolve()).replace('\\','/') for dirpath in self.incdirs]
-        self.defines += ['TOP_NAME=%s' % self.top, 'SIM']
+        # some preprocessing (paths are resolved again only if lists were changed since the last run)
+        if tuple(self.sources) != self._resolved_sources:
+            self.sources = [os.path.abspath(filepath).replace(os.sep, '/') for filepath in self.sources]
+            self._resolved_sources = tuple(self.sources)
+        if tuple(self.incdirs) != self._resolved_incdirs:
+            self.incdirs = [os.path.abspath(dirpath).replace(os.sep, '/') for dirpath in self.incdirs]
+            self._resolved_incdirs = tuple(self.incdirs)
+        self.defines += [d for d in ['TOP_NAME=%s' % self.top, 'SIM'] if d not in self.defines]
         self.params += []
+        # empty sim_errors disables error scanning (an empty pattern would match every line)
+        self._err_re = re.compile(b'|'.join(re.escape(err.encode('utf-8')) for err in self.sim_errors)) \
+                       if self.sim_errors else None
+        self.stdout = ''
+        self._stdout_parts = []
         # run simulation
-        self._runners[self.name]()
-
+        getattr(self, Simulator._RUNNERS[self.name])()
+
+    def _clear_transient(self):
+        """Remove files regenerated on every run, keep compiled libraries"""
+        for pattern in TRANSIENT_FILES:
+            for path in self.cwd.glob(pattern):
+                if path.is_file():
+                    path.unlink()
+
+    def _design_files(self):
+        """Return sorted list of files design may depend on: sources, all files
+        under incdirs and HEADER_EXTS files under directories of the sources
+        """
+        files = set(self.sources)
+        for topdir in self.incdirs:
+            for dirpath, _, filenames in os.walk(topdir):
+                files.update(os.path.join(dirpath, name) for name in filenames)
+        for topdir in {os.path.dirname(src) for src in self.sources}:
+            for dirpath, _, filenames in os.walk(topdir):
+                files.update(os.path.join(dirpath, name) for name in filenames
+                             if file_ext(name) in HEADER_EXTS)
+        return sorted(files)
+
+    def _design_signature(self):
+        """Hash tool setup and (path, mtime, size) of all design files"""
+        sig = hashlib.sha1(repr((self.name, self.top, self.worklib,
+                                 self.defines, self.params, self.incdirs)).encode('utf-8'))
+        files = self._design_files()
+        print('Design signature over %d files' % len(files))
+        for filepath in files:
+            st = os.stat(filepath)
+            sig.update(('%s:%d:%d\n' % (filepath, st.st_mtime_ns, st.st_size)).encode('utf-8'))
+        return sig.hexdigest()
+
+    def _is_elaborated(self):
+        """Check if elaboration results from the previous run can be reused (incremental mode only)"""
+        if not self.incremental:
+            return False
+        self._signature = self._design_signature()
+        try:
+            if self._sig_path.read_text(encoding="utf-8") == self._signature:
+                return True
+        except FileNotFoundError:
+            return False
+        # inputs changed: invalidate until the new elaboration succeeds
+        self._sig_path.unlink()
+        return False
+
+    def _save_signature(self):
+        """Remember design signature after successful elaboration (incremental mode only)"""
+        if self.incremental and self._signature is not None:
+            self._sig_path.write_text(self._signature, encoding="utf-8")
+
+    # define/param maps are rebuilt when the list is reassigned or its length changes;
+    # replacing an item in place (defines[i] = ...) needs the list to be reassigned
     def get_define(self, name):
         """Return define value from defines list"""
-        return get_define(name, self.defines)
-    
+        if self._defines_key is not self.defines or len(self.defines) != self._defines_len:
+            self._defines_key, self._defines_len = self.defines, len(self.defines)
+            self._defines_map = index_values(self.defines)
+        return self._defines_map.get(name)
+
     def get_param(self, name):
-        return get_param(name, self.params)
+        """Return parameter value from params list"""
+        if self._params_key is not self.params or len(self.params) != self._params_len:
+            self._params_key, self._params_len = self.params, len(self.params)
+            self._params_map = index_values(self.params)
+        return self._params_map.get(name)
+
+    def _log(self, line):
+        """Buffer output line, it is written to stdout in batches"""
+        self._log_buf.append(line)
+        self._log_size += len(line)
+        if len(self._log_buf) >= 64 or self._log_size >= 16384:
+            self._flush_log()
+
+    def _flush_log(self):
+        """Write buffered output lines to stdout and keep them for self.stdout"""
+        if self._log_buf:
+            text = '\n'.join(self._log_buf) + '\n'
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            self._stdout_parts.append(text)
+            self._log_buf.clear()
+            self._log_size = 0
 
     def _exec(self, prog, args):
         """Execute external program.
         Args:
             prog : string with program name
-            args : string with program arguments
+            args : list with program arguments
         """
-        exec_str = prog + ' ' + args
+        exec_str = ' '.join([prog] + args)
         print(exec_str)
-        child = subprocess.Popen(exec_str, shell=True, cwd=self.cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        argv = [shutil.which(prog) or prog] + args
+        try:
+            if self.gui or self.stream:
+                self._exec_streaming(argv)
+            else:
+                self._exec_batch(argv)
+        finally:
+            self.stdout = ''.join(self._stdout_parts)
 
-        """Reading shell output """
-        while True:
-            output = child.stdout.readline().decode('utf-8').strip()
-
-            if output == '' and child.poll() is not None:
-                break
-            
-            """Check shell output for errors """
-            for err in self.sim_errors:
-                if err in output:
-                    child.kill()
-                    output = output.replace(err,'')
-                    raise AssertionError(output, self.defines)
-            
-            if output:
-                print(output)
-        
         """Check return code"""
-        self.retcode = child.returncode
         if self.retcode:
             raise RuntimeError("Execution failed at '%s' with return code %d!" % (exec_str, self.retcode))
 
+    def _exec_streaming(self, argv):
+        """Run program showing its output live, stop it at the first error"""
+        child = subprocess.Popen(argv, cwd=self.cwd, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        """Drain stdout and stderr concurrently"""
+        chunks = queue.Queue()
+        for pipe in (child.stdout, child.stderr):
+            threading.Thread(target=_drain_pipe, args=(pipe, chunks), daemon=True).start()
+        tails = {child.stdout: b'', child.stderr: b''}
+
+        """Reading shell output """
+        try:
+            while tails:
+                pipe, chunk = chunks.get()
+                if chunk:
+                    *lines, tails[pipe] = (tails[pipe] + chunk).split(b'\n')
+                else:
+                    lines = [tails.pop(pipe)]
+
+                for output in lines:
+                    output = output.strip()
+
+                    """Check shell output for errors (raw bytes, decoded only for reporting)"""
+                    err = self._err_re and self._err_re.search(output)
+                    if err:
+                        child.kill()
+                        child.wait()
+                        self.retcode = child.returncode
+                        output = output.replace(err.group(), b'').decode('utf-8', errors='replace')
+                        raise AssertionError(output, self.defines)
+
+                    if output:
+                        self._log(output.decode('utf-8', errors='replace'))
+
+                # nothing else is pending: show what we have instead of waiting for a full batch
+                if chunks.empty():
+                    self._flush_log()
+        finally:
+            self._flush_log()
+        child.wait()
+        self.retcode = child.returncode
+
+    def _exec_batch(self, argv):
+        """Run program to completion, then scan its whole output for errors at once
+        (output is held in memory and shown only after the program exits)
+        """
+        child = subprocess.run(argv, cwd=self.cwd, capture_output=True, check=False)
+        self.retcode = child.returncode
+        for output in (child.stdout, child.stderr):
+            err = self._err_re and self._err_re.search(output)
+            if err:
+                # report the line with the error, as the streaming reader does
+                start = output.rfind(b'\n', 0, err.start()) + 1
+                end = output.find(b'\n', err.end())
+                line = output[start:end if end >= 0 else len(output)].strip()
+                text = _output_text(output[:start])
+                if text:
+                    self._log(text)
+                self._flush_log()
+                raise AssertionError(line.replace(err.group(), b'').decode('utf-8', errors='replace'), self.defines)
+            text = _output_text(output)
+            if text:
+                self._log(text)
+        self._flush_log()
+
     def _run_icarus(self):
         """Run Icarus + GTKWave"""
         print('Run Icarus (cwd=%s)' % self.cwd)
         print(' '.join([d for d in self.defines]))
         # elaborate
-        elab_args = ''
-        elab_args += ' '.join(['-I %s' % incdir for incdir in self.incdirs]) + ' '
-        elab_args += ' '.join(['-D %s' % define for define in self.defines]) + ' '
-        elab_args += '-g2005-sv -s %s -o %s.vvp' % (self.top, self.worklib) + ' '
-        elab_args += ' '.join(self.sources)
-        self._exec('iverilog', elab_args)
+        elab_args = []
+        for incdir in self.incdirs:
+            elab_args += ['-I', incdir]
+        for define in self.defines:
+            elab_args += ['-D', define]
+        elab_args += ['-g2005-sv', '-s', self.top, '-o', '%s.vvp' % self.worklib]
+        elab_args += self.sources
+        if not self._is_elaborated():
+            self._exec('iverilog', elab_args)
+            self._save_signature()
         # simulate
-        self._exec('vvp', '%s.vvp -lxt2' % self.worklib)
+        self._exec('vvp', ['%s.vvp' % self.worklib, '-lxt2'])
         # show waveforms
         if self.gui:
-            self._exec('gtkwave', 'dump.vcd')
+            self._exec('gtkwave', ['dump.vcd'])
 
     def _run_modelsim(self):
         """Run Modelsim"""
@@ -167,13 +427,12 @@ class Simulator:
         defines = ' '.join(['+define+' + define for define in self.defines])
         incdirs = ' '.join(['+incdir+' + incdir for incdir in self.incdirs])
         params  = ''.join(['-G ' + param + ' ' for param in self.params])
-        sources = ''
-        for src in self.sources:
-            ext = file_ext(src)
-            if ext in ['.v', '.sv']:
-                sources += 'vlog -nologo -suppress 2902 %s %s -sv -timescale \"1 ns / 1 ps\" %s\n' % (defines, incdirs, src)
-            elif ext == '.vhd':
-                sources += 'vcom -93 %s\n' % src
+        # compile commands are kept in GUI mode, so that 'rr' still recompiles edited sources
+        # (signature is still checked in GUI mode, so it can be saved after this compilation)
+        compiled = self._is_elaborated() and not self.gui
+        # defines and incdirs are the same for every source, they are set once as $DEFS and $INCS
+        sources = '\n'.join([_MODELSIM_TMPL[ext] % src for src in ([] if compiled else self.sources)
+                             if (ext := file_ext(src)) in _MODELSIM_TMPL])
         if not self.gui:
             run = 'run -all'
         else:
@@ -186,6 +445,8 @@ class Simulator:
             proc q  {{}} {{quit -force}}
             vlib {worklib}
             vmap work {worklib}
+            set DEFS [list {defines}]
+            set INCS [list {incdirs}]
             {sources}
             eval vsim {worklib}.{top} {params}
             if [file exist wave.do] {{
@@ -194,7 +455,7 @@ class Simulator:
             {run}
             """
     
-        with path_join(self.cwd, 'compile.tcl').open(mode='w', encoding="utf-8") as f:
+        with open(os.path.join(self.cwd, 'compile.tcl'), mode='w', encoding="utf-8") as f:
             f.write(compile_tcl.format(worklib=self.worklib,
                                        top=self.top,
                                        incdirs=incdirs,
@@ -202,42 +463,49 @@ class Simulator:
                                        defines=defines,
                                        params=params,
                                        run=run))
-        vsim_args = '-do compile.tcl'
+        vsim_args = ['-do', 'compile.tcl']
         if not self.gui:
-            vsim_args += ' -c -64 '
-            vsim_args += ' -onfinish exit'
+            vsim_args += ['-c', '-64']
+            vsim_args += ['-onfinish', 'exit']
         else:
-            vsim_args += ' -onfinish stop'
+            vsim_args += ['-onfinish', 'stop']
         self._exec('vsim', vsim_args)
+        if not compiled:
+            self._save_signature()
 
 
-    def _src_vivado(self, src):
-        srcc = ''
-        match file_ext(src):
-            case '.sv':  srcc += 'sv work %s\n' % src
-            case '.v':   srcc += 'verilog work %s\n' % src
-            case '.vhd': srcc += 'vhdl work %s\n' % src
-            case _:
-                for file_path in Path(src).glob('**/*'):
-                    srcc += self._src_vivado(file_path)
+    def _src_vivado(self, src, srcc):
+        """Append project file lines for src (file or directory) to srcc list"""
+        tmpl = _VIVADO_TMPL.get(file_ext(src))
+        if tmpl:
+            srcc.append(tmpl % src)
+        else:
+            for file_path in Path(src).glob('**/*'):
+                self._src_vivado(file_path, srcc)
         return srcc
 
 
     def _run_vivado(self):
-        """Run Vivado simulator"""
+        """Run Vivado simulator
+        (xelab compiles incrementally on its own, incremental mode only keeps its xsim.dir)
+        """
         print('Run Vivado (cwd=%s)' % self.cwd)
         print(' '.join([d for d in self.defines]))
         print(' '.join([d for d in self.params]))
         # prepare and run elaboration
-        elab_args = "-a --prj files.prj %s -R -nolog " % self.top
-        elab_args += ' '.join(['-d \"%s\"' % define for define in self.defines]) + ' '
-        elab_args += ' '.join(['--generic_top \"%s\"' % param for param in self.params]) + ' '
-        elab_args += ' '.join(['-i ' + incdir for incdir in self.incdirs]) + ' '
-        sources = ''
+        elab_args = ['-a', '--prj', 'files.prj', self.top, '-R', '-nolog']
+        for define in self.defines:
+            elab_args += ['-d', define]
+        for param in self.params:
+            elab_args += ['--generic_top', param]
+        for incdir in self.incdirs:
+            elab_args += ['-i', incdir]
+        sources = []
         for src in self.sources:
-            sources += self._src_vivado(src)
+            self._src_vivado(src, sources)
+        sources = ''.join(sources)
 
-        with path_join(self.cwd, 'files.prj').open(mode='w', encoding="utf-8") as f:
+        with open(os.path.join(self.cwd, 'files.prj'), mode='w', encoding="utf-8") as f:
             f.write(sources)
         self._exec('xelab', elab_args)
 